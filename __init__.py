@@ -1,3 +1,3 @@
 from .src import SPELLCHOICE_ORIG, ABBRCHOICE_ABBR, TEXT_PARAMS
 from .src import TEXT_PREVIEW_TEMPLATE, OUTLINE_PREVIEW_TEMPLATE
-from .src import parse_xml_file, generate_html, generate_outline
+from .src import parse_xml_file, generate_html, generate_outline, build_outline
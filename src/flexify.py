@@ -4,188 +4,230 @@ in the ticha_magic converter. Users of this library should only use the flexify(
 function.
 """
 import json
-from contextlib import contextmanager
-from lxml import sax
+from copy import deepcopy
+from functools import lru_cache
+from lxml import etree
 import logging
+import os
 import re
+import sys
+import unicodedata
+
+try:
+    # If orjson is installed, use it to parse FLEx exports; it is faster than the json
+    # module, but optional.
+    import orjson
+except ImportError:
+    orjson = None
 
 def flexify(html_root, flex_path):
-    """Insert FLEx annotations after every Zapotec word in the HTML root element."""
-    with open(flex_path, 'r', encoding='utf-8') as f:
-        flex_dict = json.load(f)
-    logging.debug(f'{len(flex_dict)} word(s) in the FLEx dictionary')
-    handler = FLExParser(flex_dict)
-    sax.saxify(html_root, handler)
-    logging.debug(f'Processed {handler.total} word(s), missed {handler.missed}')
-    return handler.etree
+    """
+    Insert FLEx annotations after every Zapotec word in the HTML root element. Each
+    <mark> tag is wrapped in a <span> for the popovers script, followed by a <span> with
+    the annotation. The tree is modified in place and returned.
+    """
+    flex_dict = load_flex_dict(flex_path)
+    # Find each <mark> tag's section before any of the tree is changed. <div> tags
+    # identify their section in their id attributes.
+    marks = []
+    section = ''
+    for element in html_root.iter('div', 'mark'):
+        if element.tag == 'mark':
+            marks.append((element, section))
+        else:
+            new_section = element.get('id')
+            if new_section:
+                # Convert 2.01 to 2.1 etc.
+                section = sys.intern(new_section.replace('.0', '.'))
+
+    total = missed = 0
+    tables = {}
+    section_words, matched_section = match_sections(flex_dict, ''), ''
+    for mark, section in marks:
+        if section != matched_section:
+            section_words = match_sections(flex_dict, section)
+            matched_section = section
+        popover = etree.Element('span', {'class': 'popover-markup inline'})
+        mark.addprevious(popover)
+        # The text after the <mark> tag now follows the <span>.
+        popover.tail, mark.tail = mark.tail, None
+        popover.append(mark)
+        word = ''.join(mark.itertext())
+        if word:
+            # Add the FLEx data.
+            flex_word = lookup_in_sections(section_words, word)
+            # Keep track of the missed words.
+            total += 1
+            if not flex_word:
+                missed += 1
+            content = etree.SubElement(popover, 'span', {'class': 'content hide inline'})
+            if flex_word:
+                # The same word often appears many times, so each annotation's table is
+                # only built once and then copied.
+                table = tables.get(id(flex_word))
+                if table is None:
+                    table = tables[id(flex_word)] = make_flex_table(flex_word)
+                content.append(deepcopy(table))
+    logging.debug(f'Processed {total} word(s), missed {missed}')
+    return html_root
+
+
+def load_flex_dict(flex_path):
+    """
+    Load the FLEx-to-JSON export at flex_path (see the docstring of flexml_to_json.py
+    for its format) and index it by section, so that the result maps each section to a
+    dictionary from words to their FLEx annotations.
+
+    The result is cached, so that a process that generates several versions of a text
+    only loads the export once, and so it must not be modified. The export is loaded
+    again if its file has been modified since.
+    """
+    return _load_flex_dict(flex_path, os.path.getmtime(flex_path))
+
+
+@lru_cache(maxsize=4)
+def _load_flex_dict(flex_path, mtime):
+    with open(flex_path, 'rb') as f:
+        data = f.read()
+    flex_json = orjson.loads(data) if orjson else json.loads(data)
+    logging.debug(f'{len(flex_json)} word(s) in the FLEx dictionary')
+    flex_dict = {}
+    for word, found_words in flex_json.items():
+        for found_word in found_words:
+            # If a word is listed more than once for the same section, the first
+            # annotation wins.
+            words = flex_dict.setdefault(sys.intern(found_word['section']), {})
+            words.setdefault(sys.intern(word), found_word['flex'])
+    return flex_dict
+
+
+def make_flex_table(flex_word):
+    """Return a <table> element for the FLEx annotation."""
+    morphs = flex_word['morphs']
+    lex_glosses = flex_word['lex_glosses']
+    table = etree.Element('table')
+    etree.SubElement(table, 'caption').text = flex_word['name']
+    # If at least one morph and at least one gloss item is non-empty, add the whole list
+    # to the table.
+    if any(morphs) and any(lex_glosses):
+        make_table_row(table, morphs)
+        make_table_row(table, lex_glosses)
+    en_gloss = etree.SubElement(table, 'td', {'colspan': str(len(morphs))})
+    en_gloss.text = "'" + flex_word['en_gloss'] + "'"
+    return table
+
+
+def make_table_row(table, entries):
+    row = etree.SubElement(table, 'tr')
+    for entry in entries:
+        etree.SubElement(row, 'td').text = entry
 
 
-class FLExParser(sax.ElementTreeContentHandler):
+def lookup(flex_dict, word, section):
     """
-    This parser adds the FLEx data to every Zapotec word contained in a <mark> tag.
+    Look up a word that appears in a certain section of the text in the FLEx dictionary,
+    as indexed by load_flex_dict. Return the word as a JSON object (see the docstring of
+    flexml_to_json.py for the exact format).
+    """
+    return lookup_in_sections(match_sections(flex_dict, section), word)
 
-    The reason it uses SAX parsing is that it needs to give each <mark> tag a new <span>
-    parent tag, which is difficult to do with a DOM parser but relatively simple with a
-    SAX one.
 
-    Note that this parser will not preserve HTML comments, processing instructions, or
-    anything else that is not a tag or text.
+def match_sections(flex_dict, section):
     """
+    Return the word dictionaries of the sections in the FLEx dictionary that match a
+    section of the text, from the most to the least precise.
 
-    def __init__(self, flex_dict, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.in_mark_tag = False
-        self.flex_dict = flex_dict
-        self.total = 0
-        self.missed = 0
-        # The current word and section that the parser is processing.
-        self.word, self.section = '', ''
-
-    def startElement(self, tag, attributes=None):
-        """
-        A helper function that wraps startElementNS, without bothering with namespaces.
-        """
-        if attributes:
-            attributes = {(None, key): val for key, val in attributes.items()}
-        super().startElementNS((None, tag), tag, attributes)
-
-    def endElement(self, tag):
-        """
-        A helper function that wraps endElementNS, without bothering with namespaces.
-        """
-        super().endElementNS((None, tag), tag)
-
-    @contextmanager
-    def E(self, tag, attributes=None):
-        self.startElement(tag, attributes)
-        yield
-        self.endElement(tag)
-
-    def startElementNS(self, ns_name, qname, attributes=None):
-        if qname == 'mark':
-            # Wrap each <mark> tag in a <span> for the popovers script.
-            self.startElement('span', {'class': 'popover-markup inline'})
-            self.in_mark_tag = True
-        elif qname == 'div':
-            # <div> tags identify their section in their id attributes.
-            new_section = attributes.get((None, 'id'))
-            if new_section:
-                # Convert 2.01 to 2.1 etc.
-                self.section = new_section.replace('.0', '.')
-        super().startElementNS(ns_name, qname, attributes)
-
-    def endElementNS(self, ns_name, qname):
-        super().endElementNS(ns_name, qname)
-        if qname == 'mark':
-            if self.word:
-                # Add the FLEx data.
-                flex_word = lookup(self.flex_dict, self.word, self.section)
-                # Keep track of the missed words.
-                self.total += 1
-                if not flex_word:
-                    self.missed += 1
-                with self.E('span', {'class': 'content hide inline'}):
-                    self.createFLExWord(flex_word)
-            self.endElement('span')
-            self.in_mark_tag = False
-            self.word = ''
-
-    def createFLExWord(self, flex_word):
-        if not flex_word:
-            return
-        name = flex_word['name']
-        morphs = flex_word['morphs']
-        lex_glosses = flex_word['lex_glosses']
-        en_gloss = flex_word['en_gloss']
-        with self.E('table'):
-            with self.E('caption'):
-                super().characters(name)
-            # If at least one morph and at least one gloss item is non-empty, add the
-            # whole list to the table.
-            if any(morphs) and any(lex_glosses):
-                self.createTableRow(morphs)
-                self.createTableRow(lex_glosses)
-            with self.E('td', {'colspan': str(len(morphs))}):
-                super().characters("'" + en_gloss + "'")
-
-    def createTableRow(self, entries):
-        with self.E('tr'):
-            for entry in entries:
-                with self.E('td'):
-                    super().characters(entry)
-
-    def characters(self, data):
-        if self.in_mark_tag:
-            # Add the data to the current word.
-            self.word += data
-        super().characters(data)
+    Sometimes the sections in the actual text are more precise than the ones in the FLEx
+    export (i.e. the text will list 2.3.1.4 while the FLEx will only have 2.3) so every
+    section that is a prefix of the text's section matches, not just the section itself.
+    """
+    prefixes = [section] + [section[:end] for end in range(len(section) - 1, 0, -1)]
+    return [flex_dict[prefix] for prefix in prefixes if prefix in flex_dict]
 
 
-def lookup(flex_dict, word, section):
+def lookup_in_sections(section_words, word):
     """
-    Look up a word that appears in a certain section of the text in the FLEx dictionary.
-    Return the word as a JSON object (see the docstring of flexml_to_json.py for the
-    exact format).
+    Same as lookup, but takes the result of match_sections instead of the FLEx
+    dictionary and the section.
     """
     word = strip_accents_and_spaces(word)
-    best_match = ''
-    best_match_ret = {}
-    for found_word in flex_dict.get(word, []):
-        found_section = found_word['section']
-        if found_section == section:
-            return found_word['flex']
-        # Sometimes the sections in the actual text are more precise than the ones in
-        # the FLEx export (i.e. the text will list 2.3.1.4 while the FLEx will only have
-        # 2.3) so we look for sections that partially match.
-        elif section.startswith(found_section):
-            if len(found_section) > len(best_match):
-                best_match = found_section
-                best_match_ret = found_word['flex']
-    return best_match_ret
-
-
+    for words in section_words:
+        if word in words:
+            return words[word]
+    return {}
+
+
+# Accented characters that are stripped down to their base letter by
+# strip_accents_and_spaces. Whitespace is mapped to None so that the same table also
+# removes it (there are no whitespace code points above U+3000).
+_ACCENT_TABLE = str.maketrans({
+    'ǎ': 'a',
+    'á': 'a',
+    'ä': 'a',
+    'à': 'a',
+    'ã': 'a',
+    'ā': 'a',
+    'é': 'e',
+    'ě': 'e',
+    'è': 'e',
+    'ē': 'e',
+    'ï': 'i',
+    'í': 'i',
+    'î': 'i',
+    'ì': 'i',
+    'ó': 'o',
+    'ö': 'o',
+    'ǒ': 'o',
+    'ô': 'o',
+    'õ': 'o',
+    'ſ': 's',
+    'û': 'u',
+    'ǔ': 'u',
+    'ú': 'u',
+    **{c: None for c in map(chr, range(0x3001)) if c.isspace()},
+})
+# Replacements whose keys are more than one code point long even in NFC (there is no
+# precomposed q with tilde, or a with caron and tilde), and so can't go in the
+# translation table. They are applied in order, before the table.
+_MULTI_CODEPOINT_ACCENTS = [
+    ('ǎ\u0303', 'a'),
+    ('q\u0303', 'q'),
+    ('q\u0303\u0303', 'q'),
+    ('q~', 'que'),
+]
+_PLAIN_WORD_RE = re.compile(r'[a-z]*')
+_BRACKET_RE = re.compile(r'\[\w+\]')
+_PUNCTUATION = frozenset([',', '.', '[', ']', "'", '?', '*', '’', '-'])
+# Accents, whitespace and punctuation in one table, for strings with no square brackets.
+_STRIP_TABLE = {**_ACCENT_TABLE, **dict.fromkeys(map(ord, _PUNCTUATION))}
+
+
+@lru_cache(maxsize=65536)
 def strip_accents_and_spaces(s):
     """
     Remove whitespace, punctuation and accents from accented characters in s, convert to
     lowercase, and remove letters in between square brackets.
+
+    The result is interned, like the words in the FLEx dictionary, so looking it up
+    there usually finds the very same string object.
     """
-    accent_dict = {
-        'ǎ': 'a',
-        'ã': 'a',
-        'á': 'a',
-        'ä': 'a',
-        'à': 'a',
-        'ã': 'a',
-        'ā': 'a',
-        'é': 'e',
-        'ě': 'e',
-        'è': 'e',
-        'ē': 'e',
-        'ï': 'i',
-        'í': 'i',
-        'î': 'i',
-        'ì': 'i',
-        'ó': 'o',
-        'ö': 'o',
-        'ǒ': 'o',
-        'ô': 'o',
-        'õ': 'o',
-        'q̃': 'q',
-        'q̃̃': 'q',
-        'q~': 'que',
-        'ſ': 's',
-        'û': 'u',
-        'ǔ': 'u',
-        'ú': 'u',
-    }
-    for key, val in accent_dict.items():
+    if _PLAIN_WORD_RE.fullmatch(s):
+        # Plain lowercase ASCII words are already normalized.
+        return sys.intern(s)
+    # Compose accented letters first, so that an accent is stripped whether the source
+    # spelled it as one code point or as a letter plus a combining mark.
+    s = unicodedata.normalize('NFC', s)
+    for key, val in _MULTI_CODEPOINT_ACCENTS:
         s = s.replace(key, val)
-    # Remove whitespace.
-    s = ''.join(s.split())
+    if '[' not in s:
+        # There is nothing between square brackets to remove, so the punctuation can
+        # go in the same pass as the accents and whitespace.
+        return sys.intern(s.translate(_STRIP_TABLE).lower())
+    # Remove accents and whitespace.
+    s = s.translate(_ACCENT_TABLE)
     s = s.lower()
     # Remove characters between square brackets.
-    s = re.sub(r'\[\w+\]', '', s)
+    s = _BRACKET_RE.sub('', s)
     # Remove punctuation.
-    punctuation_set = set([',', '.', '[', ']', "'", '?', '*', '’', '-'])
-    s = ''.join(char for char in s if char not in punctuation_set)
-    return s
+    s = ''.join(char for char in s if char not in _PUNCTUATION)
+    return sys.intern(s)
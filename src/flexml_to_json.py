@@ -23,63 +23,93 @@ where `section` is the section in the text where the word appears and `flex` con
 enough info to construct an annotation as an HTML element. Each value is a list because
 a single word may have multiple annotations in different sections.
 """
-import argparse
-import os
 import json
 from collections import defaultdict
+from io import BytesIO
 from lxml import etree
 
 from .flexify import strip_accents_and_spaces
 
 
+# XPath queries that are run on every text or word, compiled once.
+_find_text_title = etree.XPath(".//item[@type='title-abbreviation']")
+_find_phrase_words = etree.XPath('.//phrases/word')
+_find_word_items = etree.XPath('words/word/item')
+
+
 def convert_flex_to_json(infile, outfile):
     """Read an XML file exported from FLEx and write its data to a JSON file."""
-    with open(infile, 'r', encoding='utf-8') as ifsock:
-        with open(outfile, 'w', encoding='utf-8') as ofsock:
-            json_data = json.dumps(convert_flex_data_to_json(ifsock.read()), indent=1)
-            ofsock.write(json_data)
+    flex_data = convert_flex_source_to_json(infile)
+    # Write the JSON out in pieces rather than building the whole string in memory.
+    with open(outfile, 'w', encoding='utf-8') as ofsock:
+        json.dump(flex_data, ofsock, indent=1)
 
 
 def convert_flex_data_to_json(data):
     """
-    Same as convert_flex_to_json, but takes a string argument and returns a dictionary
-    (see the module docstring for a description of the dictionary's format).
+    Same as convert_flex_to_json, but takes a string (or bytes) argument and returns a
+    dictionary (see the module docstring for a description of the dictionary's format).
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return convert_flex_source_to_json(BytesIO(data))
+
+
+def convert_flex_source_to_json(source):
+    """
+    Same as convert_flex_data_to_json, but reads the XML from a filename or a file
+    object.
+
+    The XML is streamed: each <interlinear-text> element is discarded as soon as its
+    words have been read, so only one text is ever held in memory.
     """
     ret = defaultdict(list)
-    tr = etree.fromstring(data)
-    # NOTE: This findall call relies on all the <interlinear-text> elements being direct
-    # children of the root element.
-    for text_element in tr.findall('interlinear-text'):
+    for _, text_element in etree.iterparse(source, tag='interlinear-text'):
         text_name = get_text_name(text_element)
-        for word_element in text_element.findall('.//phrases/word'):
+        for word_element in _find_phrase_words(text_element):
             word_name = find_word_name(word_element)
             key = strip_accents_and_spaces(word_name)
             flex_object = make_flex_object(word_element)
             ret[key].append({'section': text_name, 'flex': flex_object})
+        text_element.clear()
+        while text_element.getprevious() is not None:
+            del text_element.getparent()[0]
     return ret
 
 
 def get_text_name(element):
     """Find the name of a text within an <interlinear-text> element."""
-    child = element.find(".//item[@type='title-abbreviation']")
+    child = _find_text_title(element)[0]
     return child.text.lower().replace(' ', '')
 
 
 def find_word_name(flex_element):
     """Given a <word> element, return the word name in Zapotec."""
-    return ' '.join(word.text for word in flex_element.findall("words/word/item"))
+    return ' '.join(item.text for item in _find_word_items(flex_element))
 
 
 def make_flex_object(flex_xml):
     """Load an XML <word> element into a FLExWord object."""
     name = find_word_name(flex_xml)
-    # Get the morphemes and their lexical glosses.
-    morphs = find_all_items(flex_xml, 'txt')
-    lex_glosses = find_all_items(flex_xml, 'gls')
-    # Get the literal English gloss.
-    en_gloss = find_item(flex_xml, 'lit')
+    # Collect the morphemes, their lexical glosses, and the literal English gloss in a
+    # single pass over the <item> descendants. Only <item> elements directly under a
+    # <morph> count as morphemes or lexical glosses, while the English gloss is the
+    # first `lit` item anywhere in the word (the empty string if it has no text).
+    morphs, lex_glosses, en_gloss = [], [], None
+    for item in flex_xml.iter('item'):
+        item_type = item.get('type')
+        if item.getparent().tag == 'morph':
+            if item_type == 'txt':
+                morphs.append(item.text or '')
+            elif item_type == 'gls':
+                lex_glosses.append(item.text or '')
+        if item_type == 'lit' and en_gloss is None:
+            en_gloss = item.text or ''
     return {
-        'name': name, 'morphs': morphs, 'lex_glosses': lex_glosses, 'en_gloss': en_gloss
+        'name': name,
+        'morphs': morphs,
+        'lex_glosses': lex_glosses,
+        'en_gloss': en_gloss or '',
     }
 
 
@@ -87,31 +117,11 @@ def make_table_row(entries):
     return '<tr>' + ''.join('<td>' + e + '</td>' for e in entries) + '</tr>'
 
 
-def find_item(parent, child_type):
-    """
-    Find the first <item> descendant of the parent element with a matching type
-    attribute and return its text. If the first matching element has no text, the empty
-    string is returned.
-    """
-    child = parent.find(".//item[@type='%s']" % child_type)
-    if child is not None:
-        if child.text:
-            return child.text
-    return ''
-
-
-def find_all_items(parent, child_type):
-    """
-    Find the all <item> descendants of the parent element with a matching type attribute
-    and return their texts as a list. <item> elements with no text appear in the list as
-    empty strings.
-    """
-    children = parent.findall(".//morph/item[@type='%s']" % child_type)
-    children_texts = [(child.text if child.text else '') for child in children]
-    return children_texts
-
-
 if __name__ == '__main__':
+    # Only needed when run as a script.
+    import argparse
+    import os
+
     parser = argparse.ArgumentParser()
     parser.add_argument('infile')
     parser.add_argument('-o', '--outfile')
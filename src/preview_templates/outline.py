@@ -19,3 +19,7 @@ OUTLINE_PREVIEW_TEMPLATE = """\
   </body>
 </html>
 """
+
+# The template split around its placeholder, so that a preview can be written as
+# prefix + outline + suffix without formatting the whole outline into a new string.
+OUTLINE_PREVIEW_PREFIX, OUTLINE_PREVIEW_SUFFIX = OUTLINE_PREVIEW_TEMPLATE.split("{}")
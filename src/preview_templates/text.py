@@ -31,3 +31,7 @@ TEXT_PREVIEW_TEMPLATE = """\
   </body>
 </html>
 """
+
+# The template split around its placeholder, so that a preview can be written as
+# prefix + document + suffix without formatting the whole document into a new string.
+TEXT_PREVIEW_PREFIX, TEXT_PREVIEW_SUFFIX = TEXT_PREVIEW_TEMPLATE.split("{}")
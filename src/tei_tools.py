@@ -1,10 +1,11 @@
-import xml.etree.ElementTree as ET
 from collections import namedtuple
-from lxml import etree, sax
+from functools import lru_cache
+from lxml import etree
 import logging
+import os
 from .flexify import flexify
 import re
-from .preview_templates import OUTLINE_PREVIEW_TEMPLATE
+from .preview_templates import OUTLINE_PREVIEW_PREFIX, OUTLINE_PREVIEW_SUFFIX
 
 # Possible settings for the <choice> tag in TEI.
 SPELLCHOICE_ORIG = "orig"
@@ -42,150 +43,151 @@ TEXT_PARAMS = {
 }
 
 
-class AugmentedContentHandler(sax.ElementTreeContentHandler):
+def paginate(pseudo_html_root, text_name):
     """
-    Augment the lxml implementation to support better error messages and provide the
-    useful (though namespace-unaware) startElement and endElement methods.
+    Paginate the output of the XSLT transformation. This entails removing all <pb/>
+    elements and adding <div class="page">...</div> elements to wrap each page. The
+    output of this function is valid HTML.
 
-    This class doesn't do anything interesting itself other than provide the above
-    services to TEIPager, which is a subclass.
+    The tree is modified in place: the <body> element becomes the outer <div>, and each
+    page break splits the page <div> it is in, along with every element that is open at
+    the break, so that each page <div> contains a copy of those elements. Column breaks
+    are turned into column <div>s first, so a page break inside a column also splits
+    the column.
     """
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # The real tag stack keeps track of the actual tags that are currently open. It
-        # is used to print more helpful error messages.
-        self.real_tag_stack = []
-
-    def startElement(self, name, attributes=None):
-        # In vanilla lxml.sax, every attribute is a (namespace, key) pair, which is a
-        # little annoying to have to write every time when you're not using a namespace.
-        # This function takes a regular dictionary and adds the empty namespace to every
-        # attribute.
-        if attributes is not None:
-            attributes = {(None, key): val for key, val in attributes.items()}
-        AugmentedContentHandler.startElementNS(self, (None, name), name, attributes)
-
-    def endElement(self, name):
-        AugmentedContentHandler.endElementNS(self, (None, name), name)
-
-    def startElementNS(self, ns_name, qname, attributes=None):
-        self.real_tag_stack.append(qname)
-        super().startElementNS(ns_name, qname, attributes)
-
-    def endElementNS(self, ns_name, qname):
-        try:
-            super().endElementNS(ns_name, qname)
-            self.real_tag_stack.pop()
-        except sax.SaxError as e:
-            msg = f"Tried to close <{qname}>"
-            if self.real_tag_stack:
-                msg += f", but last opened tag was <{self.real_tag_stack[-1]}>. Tag stack: {self.real_tag_stack}"
+    # TODO [2019-04-26]: Is text_name necessary for anything? It becomes a CSS class
+    # that's on the page <div>'s, so we should check the Ticha website's stylesheets
+    # to see if it's ever targeted.
+    tree = pseudo_html_root
+    root = tree.getroot()
+    page_class = "printed-text-page " + text_name
+    # Comments are dropped from the output, but the text after them is kept.
+    etree.strip_elements(root, etree.Comment, with_tail=False)
+
+    # Find the page and column breaks, numbering the pages and lines for error messages
+    # as we go. Page breaks of type "pdf" mark a page of the PDF scan, not of the text,
+    # so they are simply removed.
+    page_breaks = []
+    column_breaks = []
+    pdf_page_breaks = []
+    page = 0
+    line = 1
+    for element in root.iter("{*}pb", "{*}cb", "{*}br"):
+        tag = etree.QName(element).localname
+        if tag == "pb":
+            if element.get("type") == "pdf":
+                pdf_page_breaks.append(element)
             else:
-                msg += ", but no tags have been opened"
-            raise sax.SaxError(msg) from e
+                page += 1
+                line = 1
+                page_breaks.append((element, str(page), element.get("n", "")))
+        elif tag == "cb":
+            column_breaks.append((element, page, line))
+        else:
+            line += 1
+    for page_break in pdf_page_breaks:
+        _remove_keeping_tail(page_break)
+
+    _make_columns(root, column_breaks)
+
+    # Wrap the whole body in the first page <div>.
+    first_page = etree.Element("div", {
+        "class": page_class,
+        "data-n": "0",
+        "data-rvn": "0",
+    })
+    first_page.text, root.text = root.text, None
+    first_page.extend(list(root))
+    root.append(first_page)
+    root.tag = "div"
+    root.attrib.clear()
+
+    # Split the pages from the last to the first, so that the content after a page
+    # break is only ever moved once: by the time a page break is handled, everything
+    # after the next one has already been moved to a later page.
+    for page_break, page_no, recto_verso_no in reversed(page_breaks):
+        new_page = etree.Element("div", {
+            "class": page_class,
+            "data-n": page_no,
+            "data-rvn": recto_verso_no,
+        })
+        first_page.addnext(new_page)
+        _split_at(page_break, first_page, new_page)
+    return tree
 
 
-class TEIPager(AugmentedContentHandler):
+def _split_at(milestone, container, new_container):
     """
-    A SAX parser that transforms <pb/> and <cb/> tags into <div>s that wrap pages and
-    columns, respectively.
+    Move everything after the milestone element inside container to new_container,
+    copying the elements that the milestone is inside of, and remove the milestone.
     """
-
-    def __init__(self, text_name, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # The tag stack is a stack of (ns_name, qname, attributes) tuples that represent
-        # the current path in the tree.
-        self.tag_stack = []
-        self.page = 0
-        self.line = 1
-        self.text_name = text_name
-
-    def startElementNS(self, ns_name, qname, attributes=None):
-        if tag_eq(qname, "pb"):
-            if attributes.get((None, "type")) != "pdf":
-                recto_verso_no = attributes.get((None, "n"), "")
-                self.handlePageBreak(recto_verso_no)
-        elif tag_eq(qname, "cb"):
-            n = attributes.get((None, "n"))
-            self.handleColumnBreak(n)
-        elif tag_eq(qname, "body"):
-            self.startElement("div")
-            self.startNewPageDiv(str(self.page), "0")
+    parent = milestone.getparent()
+    node = milestone
+    copy = None
+    while node is not container:
+        node_parent = node.getparent()
+        if node_parent is container:
+            parent_copy = new_container
         else:
-            if tag_eq(qname, "br"):
-                self.line += 1
-            self.tag_stack.append((ns_name, qname, attributes))
-            super().startElementNS(ns_name, qname, attributes)
-
-    def handlePageBreak(self, recto_verso_no):
-        self.line = 1
-        self.page += 1
-        self.closeAllTags()
-        self.endElement("div")
-        self.startNewPageDiv(str(self.page), recto_verso_no)
-        self.reopenAllTags()
-
-    def startNewPageDiv(self, page_no, recto_verso_no):
-        attrs = {
-            "class": "printed-text-page " + self.text_name,
-            "data-n": page_no,
-            "data-rvn": recto_verso_no,
-        }
-        self.startElement("div", attrs)
-
-    def handleColumnBreak(self, n):
-        lastTag = self.tag_stack[-1][1]
-        if not lastTag == "div":
-            raise sax.SaxError(f"Column break (<cb.../>) must be inside a <div> tag: page {self.page}, line {self.line}")
-        if n == "1":
-            # A value of '1' indicates start of column section.
-            self.startElement("div")
-            self.startElement("div", {"class": "col-xs-6"})
-        elif n == "":
-            # An empty value indicates end of column section.
-            self.endElement("div")
-            self.endElement("div")
+            parent_copy = etree.Element(node_parent.tag, node_parent.attrib)
+        if copy is None:
+            parent_copy.text = node.tail
         else:
-            self.endElement("div")
-            self.startElement("div", {"class": "col-xs-6"})
-
-    def endElementNS(self, ns_name, qname):
-        # Ignore self-closing <pb> and <cb> tags; they were already handled by
-        # startElementNS.
-        if tag_eq(qname, "body"):
-            self.endElement("div")
-            self.endElement("div")
-        elif not tag_eq(qname, "pb") and not tag_eq(qname, "cb"):
-            closes = self.tag_stack.pop()
-            try:
-                super().endElementNS(ns_name, qname)
-            except sax.SaxError as e:
-                raise sax.SaxError(
-                    str(e) + f"on page {self.page}, line {self.line}"
-                ) from e
-
-    def closeAllTags(self):
-        for ns_name, qname, _ in reversed(self.tag_stack):
-            super().endElementNS(ns_name, qname)
-
-    def reopenAllTags(self):
-        for ns_name, qname, attributes in self.tag_stack:
-            super().startElementNS(ns_name, qname, attributes)
+            parent_copy.append(copy)
+            copy.tail = node.tail
+        node.tail = None
+        parent_copy.extend(list(node.itersiblings()))
+        copy, node = parent_copy, node_parent
+    parent.remove(milestone)
 
 
-def paginate(pseudo_html_root, text_name):
+def _make_columns(root, column_breaks):
     """
-    Paginate the output of the XSLT transformation. This entails removing all <pb/>
-    elements and adding <div class="page">...</div> elements to wrap each page. The
-    output of this function is valid HTML.
+    Replace the column breaks with <div>s: the first break in a <div> (n="1") starts a
+    column section, each break after it starts a new column, and a break with an empty
+    n ends the section.
     """
-    # TODO [2019-04-26]: Is text_name necessary for anything? It becomes a CSS class
-    # that's on the page <div>'s, so we should check the Ticha website's stylesheets
-    # to see if it's ever targeted.
-    handler = TEIPager(text_name)
-    sax.saxify(pseudo_html_root, handler)
-    return handler.etree
+    breaks = {column_break for column_break, _, _ in column_breaks}
+    section = None
+    for column_break, page, line in column_breaks:
+        parent = column_break.getparent()
+        if parent is root or not tag_eq(parent.tag, "div"):
+            raise ValueError(f"Column break (<cb.../>) must be inside a <div> tag: page {page}, line {line}")
+        if section is not None and section.getparent() is not parent:
+            # The last section was never ended, so it ends with its <div>.
+            section = None
+        n = column_break.get("n")
+        if n == "":
+            # An empty value indicates end of column section.
+            if section is not None:
+                section.tail = column_break.tail
+                column_break.tail = None
+                section = None
+            _remove_keeping_tail(column_break)
+            continue
+        if n == "1" or section is None:
+            # A value of '1' indicates start of column section.
+            section = etree.Element("div")
+            column_break.addprevious(section)
+        column = etree.SubElement(section, "div", {"class": "col-xs-6"})
+        column.text, column_break.tail = column_break.tail, None
+        for sibling in list(column_break.itersiblings()):
+            if sibling in breaks:
+                break
+            column.append(sibling)
+        parent.remove(column_break)
+
+
+def _remove_keeping_tail(element):
+    """Remove an element from the tree, but not the text that follows it."""
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + element.tail
+        else:
+            parent.text = (parent.text or "") + element.tail
+    parent.remove(element)
 
 
 def tag_eq(tag_in_document, tag_to_check):
@@ -193,29 +195,49 @@ def tag_eq(tag_in_document, tag_to_check):
     Compare equality of tags ignoring namespaces.
 
       tag_in_document: the value of a tag encountered while parsing a document, which
-                       may begin with a namespace.
+                       may begin with a namespace prefix ("tei:pb") or a namespace URI
+                       in braces ("{http://www.tei-c.org/ns/1.0}pb").
 
       tag_to_check: an XML/HTML tag as a literal string which MAY NOT begin with a
                     namespace.
 
     Note that this is not commutative.
     """
-    return tag_in_document == tag_to_check or tag_in_document.endswith(
-        ':' + tag_to_check
-    )
+    if tag_in_document == tag_to_check:
+        return True
+    local_name = tag_in_document.rpartition("}")[2].rpartition(":")[2]
+    return local_name == tag_to_check
 
 
 KNOWN_NAMESPACES = ["", "http://www.tei-c.org/ns/1.0"]
 
 
+def _namespaced_names(name):
+    """Return `name` and its forms in each of the KNOWN_NAMESPACES."""
+    return (name,) + tuple(f"{{{ns}}}{name}" for ns in KNOWN_NAMESPACES)
+
+
+# Every spelling of the tags and attributes that OutlineBuilder and
+# collapse_choice_whitespace look at, so that they can be checked with a single lookup
+# per element.
+_PB_TAGS = frozenset(_namespaced_names("pb"))
+_DIV_TAGS = frozenset(_namespaced_names("div"))
+_HEAD_TAGS = frozenset(_namespaced_names("head"))
+_CHOICE_TAGS = frozenset(_namespaced_names("choice"))
+_ORIG_TAGS = frozenset(_namespaced_names("orig"))
+_REG_TAGS = frozenset(_namespaced_names("reg"))
+# The only tags that OutlineBuilder needs to see.
+_OUTLINE_TAGS = _PB_TAGS | _DIV_TAGS | _HEAD_TAGS | _CHOICE_TAGS
+_TYPE_ATTRS = _namespaced_names("type")
+_ID_ATTRS = ("{http://www.w3.org/XML/1998/namespace}id",) + _namespaced_names("id")
+
+
 def outline_tag_eq(tag, tagname):
     """
     Return True if the tags are equal regardless of namespace. `tagname` should be a
     constant string with no namespace prefix, e.g. 'div'.
     """
-    return tag == tagname or any(
-        tag == f"{{{ns}}}{tagname}" for ns in KNOWN_NAMESPACES
-    )
+    return tag in _namespaced_names(tagname)
 
 
 def find_attr(attrs, attrname):
@@ -224,117 +246,137 @@ def find_attr(attrs, attrname):
     matches in the dictionary, so find_attr(attrs, 'type') and find_attr('{...}type')
     are equivalent.
     """
-    for key in attrs:
-        if key == attrname or any(
-            key == f"{{{ns}}}{attrname}" for ns in KNOWN_NAMESPACES
-        ):
-            return attrs[key]
+    return _find_attr(attrs, _namespaced_names(attrname))
+
+
+def _find_attr(attrs, keys):
+    """Same as find_attr, but takes the result of _namespaced_names."""
+    for key in keys:
+        value = attrs.get(key)
+        if value is not None:
+            return value
     return None
 
 
-Section = namedtuple("Section", ["number", "title", "page"])
+Section = namedtuple("Section", ["number", "page"])
+# Matches a title that starts with a section number, e.g. "1.3.1 Licencia".
+_SECTION_NUMBER_RE = re.compile(r"\s*(?:[0-9]+\.)*[0-9]+ +")
 
 
-class OutlineBuilder(ET.TreeBuilder):
-    def __init__(self, *args, text, first_page=0, **kwargs):
-        super().__init__(*args, **kwargs)
+class OutlineBuilder:
+    """
+    Builds the outline from the start and end events of a TEI document (see
+    build_outline). It is used like a parser target, but the outline itself is written
+    out with an lxml TreeBuilder.
+    """
+
+    def __init__(self, *, text, first_page=0):
+        self.tree_builder = etree.TreeBuilder()
         self.text = text
         self.page = first_page
         self.in_progress = None
+        # The pieces of the in-progress section's title, joined when it is written.
+        self.title_parts = []
         self.get_title = False
         # self.number is always a list of strings, e.g. ['1', '2', '7'] for section
         # 1.2.7
         self.number = ["1"]
-        super().start("div", {"class": "index"})
-        super().start("ul")
+        self.tree_builder.start("div", {"class": "index"})
+        self.tree_builder.start("ul", {})
 
     # What to do in the case of different tags
     def start(self, tag, attrs):
         # Increase page count on <pb/>
-        if outline_tag_eq(tag, "pb") and find_attr(attrs, "type") != "pdf":
+        if tag in _PB_TAGS and _find_attr(attrs, _TYPE_ATTRS) != "pdf":
             self.page += 1
         # Start section on <div xml:id="text-idX.X.X">
-        elif outline_tag_eq(tag, "div"):
-            for key, value in attrs.items():
-                if key.endswith("id"):
+        elif tag in _DIV_TAGS:
+            for key in _ID_ATTRS:
+                value = attrs.get(key)
+                if value is not None:
                     if value.startswith(self.text):
                         number = value[len(self.text) :].split(".")
                         # Write the previous section.
                         self.write_section()
-                        self.in_progress = Section(number, "", str(self.page))
+                        self.in_progress = Section(number, str(self.page))
+                        self.title_parts = []
                         break
                     else:
                         logging.warning(f'Found a <div> with the "id" attribute, but the start of its value didn\'t match the current text ID like I expected!\n{self.report_location()}\nValue of "id" attribute: "{value}"\nCurrent text ID: "{self.text}"')
         # Gather up the title of the section from all content inside <head type="outline">
-        elif outline_tag_eq(tag, "head") and find_attr(attrs, "type") == "outline":
+        elif tag in _HEAD_TAGS and _find_attr(attrs, _TYPE_ATTRS) == "outline":
             # we're inside a head tag with outline type, so start collecting up
             # the title to put in the outline
             self.get_title = True
         # Warn about <choice> tags found inside <head type="outline">
-        elif outline_tag_eq(tag, "choice"):
+        elif tag in _CHOICE_TAGS:
             if self.get_title:
                 logging.warning(f'Found a <choice> tag inside a <head> with type="outline"! This may cause strange results in the finished outline!\n{self.report_location()}')
 
     def end(self, tag):
-        if outline_tag_eq(tag, "head"):
+        if tag in _HEAD_TAGS:
             self.get_title = False
 
     def data(self, data):
         if self.get_title:
             if self.in_progress:
-                new_title = self.in_progress.title + data
-                self.in_progress = self.in_progress._replace(title=new_title)
+                self.title_parts.append(data)
 
     def close(self):
         self.write_section()
-        super().end("ul")
-        super().end("div")
-        return super().close()
+        # Close the lists of any subsections that are still open, then the top-level
+        # list.
+        for _ in range(len(self.number)):
+            self.tree_builder.end("ul")
+        self.tree_builder.end("div")
+        return self.tree_builder.close()
 
     def write_section(self):
         if self.in_progress is not None:
+            number, title = self.in_progress.number, "".join(self.title_parts)
             # Check if any nested lists need to be opened/closed based on the section
             # number.
-            how_many_to_close = len(self.number) - len(self.in_progress.number)
+            how_many_to_close = len(self.number) - len(number)
             if how_many_to_close > 0:
                 for i in range(how_many_to_close):
-                    super().end("ul")
+                    self.tree_builder.end("ul")
             elif how_many_to_close < 0:
                 how_many_to_open = -how_many_to_close
                 for i in range(
                     len(self.number), len(self.number) + how_many_to_open - 1
                 ):
-                    super().start("ul")
-                    super().start("li")
-                    super().data(".".join(self.in_progress.number[i:]))
-                    super().end("li")
+                    self.tree_builder.start("ul", {})
+                    self.tree_builder.start("li", {})
+                    self.tree_builder.data(".".join(number[i:]))
+                    self.tree_builder.end("li")
                 # Start all sections except top-level ones collapsed
+                list_id = f'section{"_".join(self.number)}'
                 if len(self.number) == 1:
-                    super().start("ul", {"id": f'section{"_".join(self.number)}', "class": "collapse in"})
+                    self.tree_builder.start("ul", {"id": list_id, "class": "collapse in"})
                 else:
-                    super().start("ul", {"id": f'section{"_".join(self.number)}', "class": "collapse", "style": "height: 0px"})
+                    self.tree_builder.start("ul", {"id": list_id, "class": "collapse", "style": "height: 0px"})
 
 
-            super().start("li")
-            super().start("a", {"href": self.make_url()})
+            self.tree_builder.start("li", {})
+            self.tree_builder.start("a", {"href": self.make_url()})
             # Warn if title starts with a section number
-            if re.match("\s*([0-9]+\.)*[0-9]+ +.*", self.in_progress.title):
-                logging.warning(f'Found a <head> with type="outline" whose content looks like it starts with a section number. Since section numbers are added automatically by the Outline Builder, this might look like a duplicated section number in the finished outline!\n{self.report_location()}\nContent: "{self.in_progress.title}"')
-            super().data(
-                f'{".".join(self.in_progress.number)} {self.in_progress.title.strip()}'
+            if _SECTION_NUMBER_RE.match(title):
+                logging.warning(f'Found a <head> with type="outline" whose content looks like it starts with a section number. Since section numbers are added automatically by the Outline Builder, this might look like a duplicated section number in the finished outline!\n{self.report_location()}\nContent: "{title}"')
+            self.tree_builder.data(
+                f'{".".join(number)} {title.strip()}'
                 # i.e., 1.3.1 Licencia
             )
-            super().end("a")
+            self.tree_builder.end("a")
 
             # Generate a drop-down button for every outline item. We'll delete the ones that dont work later
-            target_section = f'section{"_".join(self.in_progress.number)}'
-            super().start("button", {"class": "collapsed", "data-toggle": "collapse", "data-target": f'#{target_section}'})
-            super().start("div", {"class": "caret"})
-            super().end("div")
-            super().end("button")
+            target_section = f'section{"_".join(number)}'
+            self.tree_builder.start("button", {"class": "collapsed", "data-toggle": "collapse", "data-target": f'#{target_section}'})
+            self.tree_builder.start("div", {"class": "caret"})
+            self.tree_builder.end("div")
+            self.tree_builder.end("button")
 
-            super().end("li")
-            self.number = self.in_progress.number
+            self.tree_builder.end("li")
+            self.number = number
 
     def make_url(self):
         return f"/en/texts/{self.text}/{self.in_progress.page}/original"
@@ -349,32 +391,105 @@ class OutlineBuilder(ET.TreeBuilder):
 
 
 
-def generate_outline(path, output_path, *, text, preview):
-    logging.debug(f"generating{' Preview' if preview else ''} Outline for {text}")
-    with open(path, "r", encoding="utf-8") as f:
-        data = f.read()
-
+def build_outline(source, *, text):
+    """
+    Build the outline of a TEI document and return its root element. `source` is either
+    the path to the document or its root element, as returned by parse_xml_file.
+
+    A document given by path is streamed with _iterparse rather than read into memory,
+    and each element is cleared as soon as it has been handled, since the outline only
+    needs the attributes of each element and the text of <head type="outline">
+    elements. An already-parsed document is walked with iterwalk and left untouched.
+    Either way, only the tags in _OUTLINE_TAGS are reported, so the other elements
+    never reach Python.
+    """
     target = OutlineBuilder(text=text)
-    parser = ET.XMLParser(target=target)
-    parser.feed(data)
-    root = target.close()
+    kinds = ("start", "end")
+    if etree.iselement(source):
+        events, clear = etree.iterwalk(source, events=kinds, tag=_OUTLINE_TAGS), False
+    else:
+        events, clear = _iterparse(source, events=kinds, tag=_OUTLINE_TAGS), True
+    for event, elem in events:
+        if event == "start":
+            target.start(elem.tag, elem.attrib)
+            continue
+
+        if target.get_title and elem.tag in _HEAD_TAGS:
+            # Neither iterparse nor iterwalk report character data, so hand over the
+            # whole title once the <head> is complete.
+            target.data("".join(elem.itertext()))
+        target.end(elem.tag)
+
+        # Don't throw anything away while the title is still being collected.
+        if clear and not target.get_title:
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    return target.close()
+
+
+def _iterparse(source, **kwargs):
+    """
+    Same as etree.iterparse, but parses with the same options as _XML_PARSER, so that
+    a document given by path is accepted whenever the parsed document would be.
+    iterparse ignores collect_ids, so the document is fed to an XMLPullParser instead.
+    """
+    parser = etree.XMLPullParser(huge_tree=True, collect_ids=False, **kwargs)
+    if hasattr(source, "read"):
+        yield from _feed(parser, source)
+    else:
+        with open(source, "rb") as f:
+            yield from _feed(parser, f)
+
+
+def _feed(parser, f):
+    while True:
+        data = f.read(64 * 1024)
+        if not data:
+            break
+        parser.feed(data)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def generate_outline(source, output_path, *, text, preview):
+    logging.debug(f"generating{' Preview' if preview else ''} Outline for {text}")
+    root = build_outline(source, text=text)
 
     # Delete button elements that don't have a corresponding section
-    existing_sections = [ul.attrib['id'] for ul in root.findall('.//ul[@id]')]
-    parent_map = {c:p for p in root.iter() for c in p}
+    existing_sections = {ul.get('id') for ul in root.iterfind('.//ul[@id]')}
     for button in root.findall('.//button'):
-        if button.attrib['data-target'][1:] not in existing_sections:
-            parent_map[button].remove(button)  # workaround for `button.getparent().remove(button)` using parent_map definition above
+        if button.get('data-target')[1:] not in existing_sections:
+            button.getparent().remove(button)
+
+    # Serialize the outline straight into the file rather than into a string first.
+    with open(output_path, "wb") as f:
+        if preview:
+            f.write(OUTLINE_PREVIEW_PREFIX.encode("utf-8"))
+        root.getroottree().write(f, encoding="utf-8")
+        if preview:
+            f.write(OUTLINE_PREVIEW_SUFFIX.encode("utf-8"))
+
+
+def load_xslt(xslt_path):
+    """
+    Parse and compile the XSLT stylesheet at `xslt_path`. Compiled stylesheets are
+    cached, so that a process that generates several versions of a text only compiles
+    the stylesheet once, but a stylesheet is compiled again if its file has been
+    modified since.
+    """
+    return _compile_xslt(xslt_path, os.path.getmtime(xslt_path))
+
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        htmlstr = ET.tostring(root, encoding="unicode")
-        output = OUTLINE_PREVIEW_TEMPLATE.format(htmlstr) if preview else htmlstr
-        f.write(output)
+@lru_cache(maxsize=8)
+def _compile_xslt(xslt_path, mtime):
+    return etree.XSLT(etree.parse(xslt_path).getroot())
 
 
 def generate_html(tei_root, *, xslt_path, flex_path, text, spellchoice, abbrchoice):
     logging.debug(f"generating HTML! spellchoice: {spellchoice}")
-    xslt_transform = etree.XSLT(etree.parse(xslt_path).getroot())
+    xslt_transform = load_xslt(xslt_path)
     # Make sure that all of the keyword arguments are string-encoded, because we're
     # about to pass them to the XSLT stylesheet.
     abbrchoice = etree.XSLT.strparam(abbrchoice)
@@ -390,17 +505,40 @@ def generate_html(tei_root, *, xslt_path, flex_path, text, spellchoice, abbrchoi
 
     return html_root
 
-def preprocess_xml(xml_string):
-    # Condense each choice tag onto one line to eliminate whitespace
-    # this regex substitution matches choice tags (even across lines),
-    # captures the meaningful parts, and reassembles them without whitespace
-    regex = r'(<choice>)(?:\s|\n)*(<orig>.*?</orig>)(?:\s|\n)*(<reg type=(?:".*?"|\'.*?\')>.*?</reg>)(?:\s|\n)*(<reg type=(?:".*?"|\'.*?\')>.*?</reg>)?(?:\s|\n)*(</choice>)'
-    subst = "\\g<1>\\g<2>\\g<3>\\g<4>\\g<5>"
-    xml_no_choice_whitespace = re.sub(regex, subst, xml_string, 0, re.IGNORECASE | re.MULTILINE)
-    return xml_no_choice_whitespace
+# A single parser reused for every TEI document. TEI documents can be large, so lift
+# libxml2's size limits, and don't build the table of xml:id values, which nothing
+# here looks elements up by.
+_XML_PARSER = etree.XMLParser(huge_tree=True, collect_ids=False)
 
 def parse_xml_file(path):
-    with open(path, "r", encoding="utf-8") as f:
-        xml = f.read()
-        xml_cleaned = preprocess_xml(xml)
-        return etree.XML(bytes(xml_cleaned, encoding="utf-8"))
+    # Parse straight from the file, and then remove the whitespace inside <choice>
+    # tags from the tree.
+    tei_root = etree.parse(path, _XML_PARSER).getroot()
+    collapse_choice_whitespace(tei_root)
+    return tei_root
+
+
+def collapse_choice_whitespace(tei_root):
+    """
+    Remove the whitespace between the parts of every <choice> tag that holds an <orig>
+    and one or two <reg type="..."> tags, so that it doesn't leak into the HTML. The
+    <reg> tags may have other attributes after type.
+    """
+    for choice in tei_root.iter(*_CHOICE_TAGS):
+        parts = list(choice)
+        if not 2 <= len(parts) <= 3 or choice.attrib:
+            continue
+        if parts[0].tag not in _ORIG_TAGS or parts[0].attrib:
+            continue
+        if any(
+            part.tag not in _REG_TAGS or part.keys()[:1] != ["type"] for part in parts[1:]
+        ):
+            continue
+        gaps = [choice.text] + [part.tail for part in parts]
+        # Any Unicode whitespace counts, such as no-break spaces, as it did when this
+        # was done with a regex on the decoded document.
+        if any(gap and not gap.isspace() for gap in gaps):
+            continue
+        choice.text = None
+        for part in parts:
+            part.tail = None
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-from lxml import etree
+from concurrent.futures import ProcessPoolExecutor
 import logging
 import os
 
 from src import SPELLCHOICE_ORIG, SPELLCHOICE_SPANISH, ABBRCHOICE_ABBR, TEXT_PARAMS
-from src import TEXT_PREVIEW_TEMPLATE, OUTLINE_PREVIEW_TEMPLATE
+from src import TEXT_PREVIEW_PREFIX, TEXT_PREVIEW_SUFFIX
 from src import parse_xml_file, generate_html, generate_outline
 
 def make_all_files(path, text, xslt_path, flex_path):
@@ -14,35 +14,84 @@ def make_all_files(path, text, xslt_path, flex_path):
         ('orig', False),
         ('reg',  True)
     ]
+    jobs = [
+        (text, xslt_path, flex_path, suffix, regularized)
+        for suffix, regularized in versions_to_generate
+    ]
 
-    tei_root = parse_xml_file(path)
+    if available_cpus() > 1:
+        # The versions of the HTML don't depend on each other, so each one is generated
+        # in its own process. lxml trees can't be sent to another process, so each
+        # worker parses the TEI itself, which is cheap next to the XSLT transformation
+        # and the FLEx insertion.
+        log_level = logging.getLogger().level
+        with ProcessPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [
+                executor.submit(make_html_files_from_path, log_level, path, *job)
+                for job in jobs
+            ]
+            # Meanwhile, generate the outlines in this process.
+            make_outline_files(parse_xml_file(path), text)
+            # Raise any exception from the workers.
+            for future in futures:
+                future.result()
+    else:
+        # With a single CPU, worker processes would only add overhead.
+        tei_root = parse_xml_file(path)
+        for job in jobs:
+            make_html_files(tei_root, *job)
+        make_outline_files(tei_root, text)
 
-    # Generate HTML for each option from the XML
-    for suffix, regularized in versions_to_generate:
-        html_root = generate_html(
-            tei_root,
-            xslt_path=xslt_path,
-            flex_path=flex_path,
-            text=text,
-            spellchoice=SPELLCHOICE_SPANISH if regularized else SPELLCHOICE_ORIG,
-            abbrchoice=ABBRCHOICE_ABBR,
-        )
 
-        # Write output
-        htmlstr = etree.tostring(html_root, method="xml", encoding="unicode")
-        with open(f'{text}_{suffix}.html', "w", encoding="utf-8") as f:
-            f.write(htmlstr)
+def available_cpus():
+    """
+    Return the number of CPUs this process may run on, which can be fewer than the
+    machine has, e.g. in a container.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
-        # Write preview
-        preview_htmlstr = TEXT_PREVIEW_TEMPLATE.format(htmlstr)
-        with open(f'previews/{suffix}_preview.html', "w", encoding="utf-8") as f:
-            f.write(preview_htmlstr)
 
-    # Generate outline
-    generate_outline(path, f'{text}_outline.html', text=text, preview=False)
+def make_outline_files(tei_root, text):
+    # Generate outline from the already-parsed document, rather than parsing the file
+    # again
+    generate_outline(tei_root, f'{text}_outline.html', text=text, preview=False)
 
     # Generate preview outline
-    generate_outline(path, 'previews/outline_preview.html', text=text, preview=True)
+    generate_outline(tei_root, 'previews/outline_preview.html', text=text, preview=True)
+
+
+def make_html_files_from_path(log_level, path, *args):
+    """
+    Same as make_html_files, but parses the XML at path first. It runs in a worker
+    process, so it first sets up logging at the main process's level.
+    """
+    logging.basicConfig(level=log_level)
+    make_html_files(parse_xml_file(path), *args)
+
+
+def make_html_files(tei_root, text, xslt_path, flex_path, suffix, regularized):
+    """Generate one version of the HTML from the XML, and write it and its preview."""
+    html_root = generate_html(
+        tei_root,
+        xslt_path=xslt_path,
+        flex_path=flex_path,
+        text=text,
+        spellchoice=SPELLCHOICE_SPANISH if regularized else SPELLCHOICE_ORIG,
+        abbrchoice=ABBRCHOICE_ABBR,
+    )
+
+    # Write output. The document is serialized straight into each file, so the whole
+    # serialized document is never held in memory.
+    with open(f'{text}_{suffix}.html', "wb") as f:
+        html_root.write(f, method="xml", encoding="utf-8")
+
+    # Write preview
+    with open(f'previews/{suffix}_preview.html', "wb") as f:
+        f.write(TEXT_PREVIEW_PREFIX.encode("utf-8"))
+        html_root.write(f, method="xml", encoding="utf-8")
+        f.write(TEXT_PREVIEW_SUFFIX.encode("utf-8"))
 
 
 parser = argparse.ArgumentParser(description="Convert a TEI-encoded text to HTML.")
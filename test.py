@@ -1,6 +1,13 @@
+import os
+import tempfile
 import unittest
+from io import BytesIO
+from unittest import mock
 from lxml import etree
 from src import *
+from src.flexify import strip_accents_and_spaces
+from src.flexml_to_json import convert_flex_data_to_json
+import tei_to_html
 
 class TestGenerateHTML(unittest.TestCase):
 
@@ -62,20 +69,223 @@ class TestGenerateOutline(unittest.TestCase):
         text = "levanto-arte"
         path = "./tests/input.xml"
 
-        with open(path, "r", encoding="utf-8") as f:
-            data = f.read()
+        root = build_outline(path, text=text)
+        generated_html_string = etree.tostring(root, encoding="unicode")
 
-        target = OutlineBuilder(text=text)
-        parser = ET.XMLParser(target=target)
-        parser.feed(data)
-        root = target.close()
-        generated_html_string = ET.tostring(root, encoding="unicode")
+        with open("./tests/output_outline.html", "r", encoding="utf-8") as g:
+            expected_html_string = g.read()
+
+        self.assertEqual(generated_html_string, expected_html_string)
+
+    def test_outline_from_tree(self):
+
+        text = "levanto-arte"
+        tei_root = parse_xml_file("./tests/input.xml")
+
+        root = build_outline(tei_root, text=text)
+        generated_html_string = etree.tostring(root, encoding="unicode")
 
         with open("./tests/output_outline.html", "r", encoding="utf-8") as g:
             expected_html_string = g.read()
 
         self.assertEqual(generated_html_string, expected_html_string)
 
+    def test_outline_duplicate_ids(self):
+        # parse_xml_file doesn't reject duplicate xml:id values, so neither does
+        # streaming from a path.
+        xml = (
+            b'<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body>'
+            b'<div xml:id="levanto-arte1"><head type="outline">One</head></div>'
+            b'<div xml:id="levanto-arte1"><head type="outline">Again</head></div>'
+            b'</body></text></TEI>'
+        )
+        root = build_outline(BytesIO(xml), text="levanto-arte")
+        self.assertEqual(len(root.findall(".//a")), 2)
+
+
+class TestMakeAllFiles(unittest.TestCase):
+    # Show long diffs
+    maxDiff = None
+
+    def make_all_files(self, cpus):
+        tests_dir = os.path.abspath("./tests")
+        xslt_path = os.path.abspath("./xslt/test.xslt")
+        flex_path = os.path.join(tests_dir, "test_flex_export.json")
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as out_dir:
+            os.chdir(out_dir)
+            try:
+                os.mkdir("previews")
+                with mock.patch("tei_to_html.available_cpus", return_value=cpus):
+                    tei_to_html.make_all_files(
+                        os.path.join(tests_dir, "input.xml"),
+                        "levanto-arte",
+                        xslt_path,
+                        flex_path,
+                    )
+                for generated, expected in [
+                    ("levanto-arte_orig.html", "output.html"),
+                    ("levanto-arte_reg.html", "output_reg.html"),
+                ]:
+                    with open(generated, "r", encoding="utf-8") as f:
+                        generated_html_string = f.read()
+                    with open(os.path.join(tests_dir, expected), "r", encoding="utf-8") as f:
+                        expected_html_string = f.read()
+                    self.assertEqual(generated_html_string, expected_html_string)
+
+                # None of the test outline's sections has subsections, so every button
+                # is removed from the written outline.
+                expected_root = etree.parse(os.path.join(tests_dir, "output_outline.html")).getroot()
+                etree.strip_elements(expected_root, "button")
+                with open("levanto-arte_outline.html", "r", encoding="utf-8") as f:
+                    generated_html_string = f.read()
+                self.assertEqual(generated_html_string, etree.tostring(expected_root, encoding="unicode"))
+                self.assertEqual(
+                    sorted(os.listdir("previews")),
+                    ["orig_preview.html", "outline_preview.html", "reg_preview.html"],
+                )
+            finally:
+                os.chdir(cwd)
+
+    def test_serial(self):
+        self.make_all_files(cpus=1)
+
+    def test_parallel(self):
+        self.make_all_files(cpus=2)
+
+
+class TestPaginate(unittest.TestCase):
+    # Show long diffs
+    maxDiff = None
+
+    def paginate(self, xml):
+        html_root = paginate(etree.ElementTree(etree.fromstring(xml)), "t")
+        return etree.tostring(html_root, encoding="unicode")
+
+    def test_page_break_in_column(self):
+        # The page break splits the column section and the column as well as the <p>.
+        xml = '<body><div><cb n="1"/>a<p>b<pb n="2r"/>c</p>d<cb n="2"/>e<cb n=""/>f</div></body>'
+        self.assertEqual(
+            self.paginate(xml),
+            '<div>'
+            '<div class="printed-text-page t" data-n="0" data-rvn="0">'
+            '<div><div><div class="col-xs-6">a<p>b</p></div></div></div>'
+            '</div>'
+            '<div class="printed-text-page t" data-n="1" data-rvn="2r">'
+            '<div><div><div class="col-xs-6"><p>c</p>d</div><div class="col-xs-6">e</div></div>f</div>'
+            '</div>'
+            '</div>',
+        )
+
+    def test_column_break_without_section(self):
+        # A column break other than n="1" with no open section starts one.
+        xml = '<body><div>a<cb n="2"/>b<cb n="3"/>c<cb n=""/>d</div></body>'
+        self.assertEqual(
+            self.paginate(xml),
+            '<div>'
+            '<div class="printed-text-page t" data-n="0" data-rvn="0">'
+            '<div>a<div><div class="col-xs-6">b</div><div class="col-xs-6">c</div></div>d</div>'
+            '</div>'
+            '</div>',
+        )
+
+    def test_column_break_outside_div(self):
+        with self.assertRaisesRegex(ValueError, "page 0, line 2"):
+            self.paginate('<body><p>a<br/>b<cb n="1"/>x</p></body>')
+        with self.assertRaisesRegex(ValueError, "page 1, line 1"):
+            self.paginate('<body><pb n="1r"/><cb n="1"/>x</body>')
+
+
+class TestCollapseChoiceWhitespace(unittest.TestCase):
+
+    def collapse(self, xml):
+        tei_root = etree.fromstring(xml)
+        collapse_choice_whitespace(tei_root)
+        return etree.tostring(tei_root, encoding="unicode")
+
+    def test_collapse(self):
+        xml = '<p><choice>\n  <orig>a</orig>\n  <reg type="spanish">b</reg>\n</choice> c</p>'
+        self.assertEqual(
+            self.collapse(xml),
+            '<p><choice><orig>a</orig><reg type="spanish">b</reg></choice> c</p>',
+        )
+
+    def test_unicode_whitespace(self):
+        xml = '<p><choice>\u00a0<orig>a</orig>\u2003<reg type="spanish">b</reg>\n</choice></p>'
+        self.assertEqual(
+            self.collapse(xml),
+            '<p><choice><orig>a</orig><reg type="spanish">b</reg></choice></p>',
+        )
+
+    def test_text_between_parts(self):
+        xml = '<p><choice>\n  <orig>a</orig> x <reg type="spanish">b</reg>\n</choice></p>'
+        self.assertEqual(self.collapse(xml), xml)
+
+    def test_reg_with_more_attributes(self):
+        xml = '<p><choice>\n  <orig>a</orig>\n  <reg type="spanish" resp="#ed">b</reg>\n</choice></p>'
+        self.assertEqual(
+            self.collapse(xml),
+            '<p><choice><orig>a</orig><reg type="spanish" resp="#ed">b</reg></choice></p>',
+        )
+
+    def test_reg_without_type_first(self):
+        xml = '<p><choice>\n  <orig>a</orig>\n  <reg resp="#ed" type="spanish">b</reg>\n</choice></p>'
+        self.assertEqual(self.collapse(xml), xml)
+
+
+class TestStripAccentsAndSpaces(unittest.TestCase):
+
+    def test_accents(self):
+        self.assertEqual(strip_accents_and_spaces('Pěni niguijo'), 'peniniguijo')
+        # Precomposed and decomposed accents are stripped alike.
+        self.assertEqual(strip_accents_and_spaces('\u00e1'), 'a')
+        self.assertEqual(strip_accents_and_spaces('a\u0301'), 'a')
+
+    def test_a_with_caron_and_tilde(self):
+        # There is no precomposed form, so NFC leaves the tilde combining.
+        self.assertEqual(strip_accents_and_spaces('\u01ce\u0303'), 'a')
+        self.assertEqual(strip_accents_and_spaces('a\u030c\u0303'), 'a')
+
+
+FLEX_XML = """\
+<document>
+<interlinear-text><item type="title-abbreviation">Cordova Arte 2.1</item><paragraphs><paragraph><phrases>
+<word><words><word><item type="txt">Pěni</item></word><word><item type="txt">niguijo</item></word></words><morphemes><morph><item type="txt">pěni</item><item type="gls">person</item></morph><morph><item type="txt">niguijo</item><item type="gls">male/man</item></morph></morphemes><item type="lit">man</item></word>
+</phrases></paragraph></paragraphs></interlinear-text>
+</document>
+"""
+
+
+class TestConvertFlexDataToJSON(unittest.TestCase):
+
+    def test_str(self):
+        self.assertEqual(
+            convert_flex_data_to_json(FLEX_XML),
+            {
+                'peniniguijo': [{
+                    'section': 'cordovaarte2.1',
+                    'flex': {
+                        'name': 'Pěni niguijo',
+                        'morphs': ['pěni', 'niguijo'],
+                        'lex_glosses': ['person', 'male/man'],
+                        'en_gloss': 'man',
+                    },
+                }],
+            },
+        )
+
+    def test_word_item_without_text(self):
+        # A malformed word is an error, rather than being stored under a shorter key.
+        xml = FLEX_XML.replace('<item type="txt">niguijo</item></word>', '<item type="txt"/></word>')
+        with self.assertRaises(TypeError):
+            convert_flex_data_to_json(xml)
+
+    def test_bytes(self):
+        self.assertEqual(
+            convert_flex_data_to_json(FLEX_XML.encode('utf-8')),
+            convert_flex_data_to_json(FLEX_XML),
+        )
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)